@@ -12,71 +12,226 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fnmatch
+import hashlib
 import os
+import pickle
+import string
+
 import nox
+from nox.command import CommandFailed
+
+
+# fastlint is a local pre-check; plain `nox` (as run by CI) only runs the
+# full test and flake8 sessions.
+nox.options.sessions = ["py", "lint"]
 
 
 #
 # Utility Functions
 #
 
+# Subdirectories are only walked if their name starts with one of these.
+_ALPHA_FIRST = frozenset(string.ascii_letters)
+
+# Subdirectories that never contain tests of their own, e.g. virtualenvs,
+# vendored and generated code. Dot and underscore dirs are already skipped
+# by _ALPHA_FIRST.
+_SKIP_DIRS = frozenset({
+    "env",
+    "generated_pb2",
+    "lib",
+    "node_modules",
+    "vendor",
+})
+
+
+def _scandir(path):
+    """Yields the entries of a directory, or nothing if it can't be listed.
+    Unreadable directories are skipped, same as os.walk's default.
+    """
+    try:
+        with os.scandir(path) as it:
+            yield from it
+    except OSError:
+        return
+
+
 def _collect_dirs(
     start_dir,
     suffix="_test.py",
     recurse_further=False,
+    visited=None,
 ):
     """Recursively collects a list of dirs that contain a file matching the given suffix.
     This works by listing the contents of directories and finding
     directories that have `*_test.py` files.
+
+    If `visited` is given, a `(path, st_mtime_ns)` pair is appended to it
+    for every directory that is listed, with the mtime taken before listing.
     """
-    # Collect all the directories that have tests in them.
-    for parent, subdirs, files in os.walk(start_dir):
-        if "./." in parent:
-            continue  # Skip top-level dotfiles
-        elif any(f for f in files if f.endswith(suffix)):
+    # Use os.scandir directly rather than os.walk: we only need entry names
+    # and types, which DirEntry provides without an extra stat() per entry.
+    def _walk(path):
+        is_dotdir = "./." in path
+        # Only these cases walk subdirectories regardless of their name.
+        keep_all = is_dotdir or recurse_further
+        has_match = False
+        subdirs = []
+        if visited is not None:
+            # Stat before listing, so a change made during the walk leaves a
+            # stale mtime behind rather than a fresh one.
+            try:
+                visited.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                return
+        for entry in _scandir(path):
+            name = entry.name
+            if name.endswith(suffix) and entry.is_file():
+                has_match = True
+                # We need neither the rest of the listing nor any
+                # subdirectories, so stop at the first match.
+                if not keep_all:
+                    break
+            elif (
+                keep_all
+                or name[0] in _ALPHA_FIRST
+                and name not in _SKIP_DIRS
+            ) and entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry)
+
+        if is_dotdir:
+            pass  # Skip top-level dotfiles
+        elif has_match:
+            # This dir has desired files in it. yield it.
+            yield path
             # Don't recurse further for tests, since py.test will do that.
             if not recurse_further:
-                del subdirs[:]
-            # This dir has desired files in it. yield it.
-            yield parent
-        else:
+                return
+        elif keep_all:
             # Filter out dirs we don't want to recurse into
-            subdirs[:] = [
-                s for s in subdirs if s[0].isalpha()
+            subdirs = [
+                s for s in subdirs
+                if s.name[0] in _ALPHA_FIRST and s.name not in _SKIP_DIRS
             ]
 
+        for subdir in subdirs:
+            yield from _walk(subdir.path)
+
+    # Collect all the directories that have tests in them.
+    yield from _walk(start_dir)
+
 
 #
 # Tests
 #
 
 
-FOLDERS = sorted(list(_collect_dirs(".")))
+_FOLDERS_CACHE = os.path.join(".nox", "_folders.cache")
+
 
+def _folders_cache_key():
+    """Returns a hash of this noxfile.
+    Any change to how the walk works (suffix, _SKIP_DIRS, _ALPHA_FIRST, ...)
+    changes the hash and so invalidates the cache.
+    """
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
-def _session_tests(session, folder):
-    """Runs py.test for a particular directory."""
-    session.chdir(folder)
 
-    if os.path.exists("requirements.txt"):
-        session.install("-r", "requirements.txt")
+def _load_folders():
+    """Returns the sorted list of test folders, cached across nox runs.
+    The cache is keyed on this noxfile and on the mtime of every directory
+    the walk listed, test and non-test alike. A directory's mtime changes
+    whenever an entry is added to, removed from or renamed in it.
+    """
+    key = _folders_cache_key()
+    try:
+        with open(_FOLDERS_CACHE, "rb") as f:
+            cached_key, visited, folders = pickle.load(f)
+        if cached_key == key and all(
+            os.stat(path).st_mtime_ns == mtime for path, mtime in visited
+        ):
+            return folders
+    except Exception:
+        pass  # Missing, stale or corrupt cache; rebuild it below.
 
-    session.run(
-        "pytest",
-        *(session.posargs),
-        # Pytest will return 5 when no tests are collected. This can happen
-        # on travis where slow and flaky tests are excluded.
-        # See http://doc.pytest.org/en/latest/_modules/_pytest/main.html
-        success_codes=[0, 5]
-    )
+    # Create .nox before walking, since doing so changes the mtime of the
+    # top-level directory.
+    try:
+        os.makedirs(".nox", exist_ok=True)
+    except OSError:
+        pass
+    visited = []
+    folders = sorted(_collect_dirs(".", visited=visited))
+    try:
+        with open(_FOLDERS_CACHE, "wb") as f:
+            pickle.dump((key, visited, folders), f)
+    except OSError:
+        pass  # Caching is best-effort.
+    return folders
+
+
+FOLDERS = _load_folders()
+
+
+def _requirements_args(folders):
+    """Returns `-r <folder>/requirements.txt` pip args for the given folders.
+    Each file is passed as-is so that pip resolves any nested includes and
+    relative paths against the folder it lives in.
+    """
+    args = []
+    for folder in folders:
+        path = os.path.join(folder, "requirements.txt")
+        if os.path.exists(path):
+            args += ["-r", path]
+    return args
+
+
+def _session_tests(session, folders):
+    """Runs py.test for each of the given directories.
+    Every folder is run even if an earlier one fails, and the session fails
+    at the end with the list of failing folders.
+    """
+    # Run a separate pytest process per folder. Sample folders commonly
+    # share module names (main.py, main_test.py) without an __init__.py,
+    # which collide in a single process; --import-mode=importlib avoids the
+    # test module clash but no longer puts the folder on sys.path, so
+    # `import main` fails.
+    failed = []
+    for folder in folders:
+        try:
+            session.run(
+                "pytest",
+                folder,
+                # Pytest will return 5 when no tests are collected. This can
+                # happen on travis where slow and flaky tests are excluded.
+                # See http://doc.pytest.org/en/latest/_modules/_pytest/main.html
+                success_codes=[0, 5]
+            )
+        except CommandFailed:
+            failed.append(folder)
+
+    if failed:
+        session.error("Tests failed in: {}".format(", ".join(failed)))
 
 
 @nox.session(python=["3.6", "3.7", "3.8"])
-@nox.parametrize("folder", FOLDERS)
-def py(session, folder):
-    """Runs py.test for a folder using the specified version of Python."""
-    session.install("-r", "test-requirements.txt")
-    _session_tests(session, folder)
+def py(session):
+    """Runs py.test for all folders using the specified version of Python.
+    Any arguments are passed to a single py.test run instead, so a single
+    folder can be tested with e.g. `nox -s py-3.8 -- path/to/folder`.
+    """
+    if not FOLDERS:
+        session.skip("No test folders found")
+
+    # Install everything in a single pip invocation.
+    session.install(*_requirements_args(FOLDERS), "-r", "test-requirements.txt")
+
+    if session.posargs:
+        session.run("pytest", *(session.posargs), success_codes=[0, 5])
+    else:
+        _session_tests(session, FOLDERS)
 
 
 #
@@ -93,22 +248,32 @@ def _determine_local_import_names(start_dir):
     This is used when running the linter to insure that import order is
     properly checked.
     """
-    file_ext_pairs = [os.path.splitext(path) for path in os.listdir(start_dir)]
-    return [
-        basename
-        for basename, extension in file_ext_pairs
-        if extension == ".py"
-        or os.path.isdir(os.path.join(start_dir, basename))
-        and basename not in ("__pycache__")
-    ]
+    with os.scandir(start_dir) as it:
+        return [
+            entry.name[:-3] if entry.name.endswith(".py") else entry.name
+            for entry in it
+            if entry.name.endswith(".py")
+            or entry.is_dir()
+            and entry.name != "__pycache__"
+        ]
+
 
+FLAKE8_EXCLUDE = [
+    ".nox",
+    ".cache",
+    "env",
+    "lib",
+    "generated_pb2",
+    "*_pb2.py",
+    "*_pb2_grpc.py",
+]
 
 FLAKE8_COMMON_ARGS = [
     "--show-source",
     "--builtin=gettext",
     "--max-complexity=20",
     "--import-order-style=google",
-    "--exclude=.nox,.cache,env,lib,generated_pb2,*_pb2.py,*_pb2_grpc.py",
+    "--exclude=" + ",".join(FLAKE8_EXCLUDE),
     "--ignore=E121,E123,E126,E203,E226,E24,E266,E501,E704,W503,W504,I100,I201,I202",
     "--max-line-length=88",
 ]
@@ -125,3 +290,40 @@ def lint(session):
         ".",
     ]
     session.run("flake8", *args)
+
+
+def _is_flake8_excluded(entry):
+    """Returns True if flake8's --exclude patterns match the given entry.
+    Like flake8, patterns are matched against both the name and the
+    absolute path.
+    """
+    return any(
+        fnmatch.fnmatch(entry.name, pattern)
+        or fnmatch.fnmatch(os.path.abspath(entry.path), pattern)
+        for pattern in FLAKE8_EXCLUDE
+    )
+
+
+def _collect_fastlint_files(start_dir):
+    """Recursively collects the Python files that pyflakes should check.
+    pyflakes has no --exclude option, so instead of passing it "." we list
+    the files ourselves, skipping the same paths as the lint session.
+    """
+    for entry in _scandir(start_dir):
+        if _is_flake8_excluded(entry):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _collect_fastlint_files(entry.path)
+        elif entry.name.endswith(".py") and entry.is_file():
+            yield entry.path
+
+
+@nox.session
+def fastlint(session):
+    """Runs pyflakes only, a quick check that skips flake8's style checks."""
+    files = sorted(_collect_fastlint_files("."))
+    if not files:
+        session.skip("No Python files found")
+
+    session.install("pyflakes")
+    session.run("pyflakes", *files)